@@ -88,6 +88,7 @@ def config():
 
     # Downstream Setting
     get_recall_metric = False
+    log_text_metrics_train = False  # compute ROUGE/BLEU on training batches as well
 
     # PL Trainer Setting
     resume_from = None
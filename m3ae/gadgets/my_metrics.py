@@ -1,15 +1,99 @@
-import numpy as np
+import functools
+import math
+
 import sklearn.metrics as sklm
 import torch
 from torchmetrics import Metric
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
-from rouge_score import rouge_scorer
-from transformers import PreTrainedTokenizerFast
+from torchmetrics.utilities.data import dim_zero_cat
+from rouge_score import tokenizers
 from transformers import BertTokenizerFast
 from collections import Counter
 import os
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
+
+def _ngrams(tokens, n):
+    return Counter(zip(*[tokens[i:] for i in range(n)]))
+
+
+def _rouge_n_recall(target_ngrams, pred_ngrams):
+    # same recall as rouge_score's _score_ngrams, without building Score tuples
+    target_count = sum(target_ngrams.values())
+    if target_count == 0:
+        return 0.0
+    return sum((target_ngrams & pred_ngrams).values()) / target_count
+
+
+def _as_text(answer):
+    return answer[0] if isinstance(answer, list) else answer
+
+
+_rouge_tokenizer = tokenizers.DefaultTokenizer(use_stemmer=True)
+# free-form generated answers are rarely repeated whole but share most of their words, so
+# Porter stems are cached per word as well
+_rouge_tokenizer._stemmer.stem = functools.lru_cache(maxsize=65536)(_rouge_tokenizer._stemmer.stem)
+
+
+# answers such as "yes"/"no" repeat constantly, so stemmed n-gram counts are cached per string
+# and recalls per (pred, target) pair. The caches are bounded by maxsize rather than cleared on
+# reset(), which torchmetrics also calls inside every forward().
+@functools.lru_cache(maxsize=65536)
+def _rouge_ngram_counts(text):
+    tokens = _rouge_tokenizer.tokenize(text)
+    return _ngrams(tokens, 1), _ngrams(tokens, 2)
+
+
+@functools.lru_cache(maxsize=65536)
+def _rouge_pair_recalls(pred_str, target_str):
+    pred_unigrams, pred_bigrams = _rouge_ngram_counts(pred_str)
+    target_unigrams, target_bigrams = _rouge_ngram_counts(target_str)
+    return _rouge_n_recall(target_unigrams, pred_unigrams), _rouge_n_recall(target_bigrams, pred_bigrams)
+
+
+def _rouge_batch_sums(preds, targets):
+    # sum in python so the caller touches its states once per batch rather than once per sample
+    rouge1_sum, rouge2_sum, count = 0.0, 0.0, 0
+    for pred, target in zip(preds, targets):
+        rouge1_score, rouge2_score = _rouge_pair_recalls(_as_text(pred), _as_text(target))
+        rouge1_sum += rouge1_score
+        rouge2_sum += rouge2_score
+        count += 1
+    return rouge1_sum, rouge2_sum, count
+
+
+def _bleu_batch_stats(tokenizer, preds, targets, max_order):
+    # corpus_bleu's sufficient statistics for a batch, with a single reference per prediction
+    matches = [0] * max_order
+    possible = [0] * max_order
+    hyp_len, ref_len = 0, 0
+    for pred, ref in zip(preds, targets):
+        pred_tokens = tokenizer.tokenize(_as_text(pred))
+        ref_tokens = tokenizer.tokenize(_as_text(ref))
+        for n in range(1, max_order + 1):
+            pred_ngrams = _ngrams(pred_tokens, n)
+            # clipped counts as in nltk's modified_precision, denominator floored at 1
+            matches[n - 1] += sum((pred_ngrams & _ngrams(ref_tokens, n)).values())
+            possible[n - 1] += max(1, sum(pred_ngrams.values()))
+        hyp_len += len(pred_tokens)
+        # a single reference is always the closest one
+        ref_len += len(ref_tokens)
+    return matches, possible, hyp_len, ref_len
+
+
+def _bleu_from_stats(matches, possible, hyp_len, ref_len):
+    # same result as nltk's corpus_bleu with uniform weights and SmoothingFunction().method1
+    matches, possible = matches.tolist(), possible.tolist()
+    hyp_len, ref_len = hyp_len.item(), ref_len.item()
+    if hyp_len == 0 or matches[0] == 0:
+        return torch.tensor(0.0)
+    brevity_penalty = 1.0 if hyp_len > ref_len else math.exp(1 - ref_len / hyp_len)
+    # method1 adds epsilon=0.1 to orders without any match
+    log_precision = math.fsum(
+        math.log((m if m > 0 else 0.1) / p) / len(matches) for m, p in zip(matches, possible)
+    )
+    return torch.tensor(brevity_penalty * math.exp(log_precision), dtype=torch.float32)
+
+
 class Accuracy(Metric):
     def __init__(self, dist_sync_on_step=False):
         super().__init__(dist_sync_on_step=dist_sync_on_step)
@@ -17,20 +101,18 @@ class Accuracy(Metric):
         self.add_state("total", default=torch.tensor(0.0), dist_reduce_fx="sum")
 
     def update(self, logits, target):
-        logits, target = (
-            logits.detach().to(self.correct.device),
-            target.detach().to(self.correct.device),
-        )
+        logits, target = logits.detach(), target.detach()
+        if logits.device != self.correct.device:
+            logits = logits.to(self.correct.device)
+        if target.device != self.correct.device:
+            target = target.to(self.correct.device)
         preds = logits.argmax(dim=-1)
-        preds = preds[target != -100]
-        target = target[target != -100]
-        if target.numel() == 0:
-            return 1
 
         assert preds.shape == target.shape
 
-        self.correct += torch.sum(preds == target)
-        self.total += target.numel()
+        mask = target != -100
+        self.correct += ((preds == target) & mask).sum()
+        self.total += mask.sum()
 
     def compute(self):
         return self.correct / self.total
@@ -45,8 +127,8 @@ class Scalar(Metric):
     def update(self, scalar):
         if isinstance(scalar, torch.Tensor):
             scalar = scalar.detach().to(self.scalar.device)
-        else:
-            scalar = torch.tensor(scalar).float().to(self.scalar.device)
+        # python numbers go straight into the in-place add as a kernel scalar, with no
+        # temporary tensor or host-to-device copy
         self.scalar += scalar
         self.total += 1
 
@@ -60,18 +142,20 @@ class VQAScore(Metric):
         self.add_state("score", default=torch.tensor(0.0), dist_reduce_fx="sum")
         self.add_state("total", default=torch.tensor(0.0), dist_reduce_fx="sum")
 
-    def update(self, logits, target):
+    def per_sample_scores(self, logits, target):
         logits, target = (
-            logits.detach().float().to(self.score.device),
+            logits.detach().to(self.score.device),
             target.detach().float().to(self.score.device),
         )
-        logits = torch.max(logits, 1)[1]
-        one_hots = torch.zeros_like(target).to(target)
-        one_hots.scatter_(1, logits.view(-1, 1), 1)
-        scores = one_hots * target
+        # read target[i, argmax_i] directly instead of building a one-hot over all answers
+        pred_idx = logits.argmax(dim=1, keepdim=True)
+        return target.gather(1, pred_idx).squeeze(1)
+
+    def update(self, logits, target):
+        scores = self.per_sample_scores(logits, target)
 
         self.score += scores.sum()
-        self.total += len(logits)
+        self.total += scores.numel()
 
     def compute(self):
         return self.score / self.total
@@ -84,82 +168,57 @@ class VQAExactMatch(Metric):
         self.add_state("total", default=torch.tensor(0.0), dist_reduce_fx="sum")
 
     def update(self, preds, targets):
+        matches, count = 0, 0
         for pred, target in zip(preds, targets):
             pred_str = pred[0] if isinstance(pred, list) else pred
             target_str = target[0] if isinstance(target, list) else target
             # print(f"prediction: {pred_str} \n target:{target_str}")
             if pred_str == target_str:
-                self.exact_match_accuracy += 1
-            self.total += 1
+                matches += 1
+            count += 1
+        self.exact_match_accuracy += matches
+        self.total += count
 
     def compute(self):
         return self.exact_match_accuracy / self.total if self.total > 0 else torch.tensor(0.0)
 
-### ROUGE-1 score
-class ROUGE1Score(Metric):
-    def __init__(self, dist_sync_on_step=False):
+#### ROUGE-1 / ROUGE-2 / BLEU in one metric
+class TextMetricsBundle(Metric):
+    # One metric (and so one torchmetrics forward()) per step for ROUGE and BLEU. Tokens are
+    # not shared: ROUGE uses stemmed rouge_score tokens and BLEU uses BERT wordpieces.
+    def __init__(self, dist_sync_on_step=False, max_order=4):
         super().__init__(dist_sync_on_step=dist_sync_on_step)
-        self.scorer = rouge_scorer.RougeScorer(['rouge1'], use_stemmer=True)
+        self.bleu_tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+        self.max_order = max_order
         self.add_state("rouge1", default=torch.tensor(0.0), dist_reduce_fx="sum")
-        self.add_state("total", default=torch.tensor(0.0), dist_reduce_fx="sum")
-
-    def update(self, preds, targets):
-        for pred, target in zip(preds, targets):
-            pred_str = pred[0] if isinstance(pred, list) else pred
-            target_str = target[0] if isinstance(target, list) else target
-            rouge1_score = self.scorer.score(target_str, pred_str)['rouge1'].recall
-            self.rouge1 += torch.tensor(rouge1_score, dtype=torch.float32)
-            self.total += 1
-
-    def compute(self):
-        return self.rouge1 / self.total if self.total > 0 else torch.tensor(0.0)
-
-### ROUGE-2 score
-class ROUGE2Score(Metric):
-    def __init__(self, dist_sync_on_step=False):
-        super().__init__(dist_sync_on_step=dist_sync_on_step)
-        self.scorer = rouge_scorer.RougeScorer(['rouge2'], use_stemmer=True)
         self.add_state("rouge2", default=torch.tensor(0.0), dist_reduce_fx="sum")
         self.add_state("total", default=torch.tensor(0.0), dist_reduce_fx="sum")
+        self.add_state("bleu_matches", default=torch.zeros(max_order), dist_reduce_fx="sum")
+        self.add_state("bleu_possible", default=torch.zeros(max_order), dist_reduce_fx="sum")
+        self.add_state("bleu_hyp_len", default=torch.tensor(0.0), dist_reduce_fx="sum")
+        self.add_state("bleu_ref_len", default=torch.tensor(0.0), dist_reduce_fx="sum")
 
     def update(self, preds, targets):
-        for pred, target in zip(preds, targets):
-            pred_str = pred[0] if isinstance(pred, list) else pred
-            target_str = target[0] if isinstance(target, list) else target
-            rouge2_score = self.scorer.score(target_str, pred_str)['rouge2'].recall
-            self.rouge2 += torch.tensor(rouge2_score, dtype=torch.float32)
-            self.total += 1
-
-    def compute(self):
-        return self.rouge2 / self.total if self.total > 0 else torch.tensor(0.0)
+        rouge1_sum, rouge2_sum, count = _rouge_batch_sums(preds, targets)
+        self.rouge1 += rouge1_sum
+        self.rouge2 += rouge2_sum
+        self.total += count
 
-        
-#### BLEU score
-class BLEUScore(Metric):
-    def __init__(self, dist_sync_on_step=False):
-        super().__init__(dist_sync_on_step=dist_sync_on_step)
-        self.tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
-        self.add_state("score", default=torch.tensor(0.0), dist_reduce_fx="sum")
-        self.add_state("total", default=torch.tensor(0.0), dist_reduce_fx="sum")
-        self.smoothing = SmoothingFunction().method1 
-
-    def update(self, preds, targets):
-        for pred, ref in zip(preds, targets):
-            # Tokenize predictions
-            pred_tokens = self.tokenizer.tokenize(pred[0] if isinstance(pred, list) else pred)
-            
-            # Tokenize references
-            ref_tokens = [self.tokenizer.tokenize(pred[0] if isinstance(pred, list) else pred)]
-            # ref_tokens = [self.tokenizer.tokenize(ref)]
-
-            bleu_score = sentence_bleu(
-                ref_tokens, pred_tokens, smoothing_function=self.smoothing
-            )
-            self.score += torch.tensor(bleu_score, dtype=torch.float32)
-            self.total += 1
+        matches, possible, hyp_len, ref_len = _bleu_batch_stats(
+            self.bleu_tokenizer, preds, targets, self.max_order
+        )
+        self.bleu_matches += torch.tensor(matches, dtype=torch.float32, device=self.bleu_matches.device)
+        self.bleu_possible += torch.tensor(possible, dtype=torch.float32, device=self.bleu_possible.device)
+        self.bleu_hyp_len += hyp_len
+        self.bleu_ref_len += ref_len
 
     def compute(self):
-        return self.score / self.total if self.total > 0 else torch.tensor(0.0)
+        if self.total > 0:
+            scores = {"rouge1": self.rouge1 / self.total, "rouge2": self.rouge2 / self.total}
+        else:
+            scores = {"rouge1": torch.tensor(0.0), "rouge2": torch.tensor(0.0)}
+        scores["bleu"] = _bleu_from_stats(self.bleu_matches, self.bleu_possible, self.bleu_hyp_len, self.bleu_ref_len)
+        return scores
 
 
 class VQARADScore(VQAScore):
@@ -176,14 +235,18 @@ class VQARADScore(VQAScore):
         self.best_open_score = 0
 
     def update(self, logits, target, types=None):
-        super().update(logits, target)
-        close_scores = (types == 0).float() * self.score
-        open_scores = (types == 1).float() * self.score
+        scores = self.per_sample_scores(logits, target)
+        self.score += scores.sum()
+        self.total += scores.numel()
 
-        self.close_score += close_scores.sum()
-        self.close_total += close_scores.numel()
-        self.open_score += open_scores.sum()
-        self.open_total += open_scores.numel()
+        types = types.to(scores.device)
+        close_mask = types == 0
+        open_mask = types == 1
+
+        self.close_score += scores[close_mask].sum()
+        self.close_total += close_mask.sum()
+        self.open_score += scores[open_mask].sum()
+        self.open_total += open_mask.sum()
 
     def get_best_score(self):
         if (self.score / self.total) > self.best_score:
@@ -216,8 +279,8 @@ class ROCScore(Metric):
     def compute(self):
         try:
             score = sklm.roc_auc_score(
-                np.concatenate([y.cpu().numpy() for y in self.y_trues], axis=0),
-                np.concatenate([y.cpu().numpy() for y in self.y_scores], axis=0)
+                dim_zero_cat(self.y_trues).cpu().numpy(),
+                dim_zero_cat(self.y_scores).cpu().numpy()
             )
             return torch.tensor(score, device=self.y_trues[0].device)
         except ValueError:
@@ -227,24 +290,33 @@ class ROCScore(Metric):
 class F1Score(Metric):
     def __init__(self, dist_sync_on_step=False):
         super().__init__(dist_sync_on_step=dist_sync_on_step)
-        self.add_state("y_trues", default=[], dist_reduce_fx="cat")
-        self.add_state("y_preds", default=[], dist_reduce_fx="cat")
+        # binary F1 only needs the confusion counts, so keep fixed-size sums instead of every batch
+        self.add_state("tp", default=torch.tensor(0.0), dist_reduce_fx="sum")
+        self.add_state("fp", default=torch.tensor(0.0), dist_reduce_fx="sum")
+        self.add_state("fn", default=torch.tensor(0.0), dist_reduce_fx="sum")
+        self.add_state("invalid", default=torch.tensor(0.0), dist_reduce_fx="sum")
 
     def update(self, logits, target):
         logits, target = (
             logits.detach().float(),
             target.detach().float(),
         )
+        if target.dim() > 1 and target.size(-1) != 1:
+            # sklearn's binary f1_score rejects multi-label targets
+            self.invalid += 1
+            return
+        # (N, 1) columns are flattened like sklearn does
+        logits, target = logits.reshape(-1), target.reshape(-1)
+        assert logits.numel() == target.numel()
+        # non-0/1 labels are also rejected by sklearn; count them on device to avoid a host sync
+        self.invalid += (~((target == 0) | (target == 1))).sum()
         y_pred = (torch.sigmoid(logits) > 0.5).float()
-        self.y_trues.append(target)
-        self.y_preds.append(y_pred)
+        self.tp += (y_pred * target).sum()
+        self.fp += (y_pred * (1 - target)).sum()
+        self.fn += ((1 - y_pred) * target).sum()
 
     def compute(self):
-        try:
-            score = sklm.f1_score(
-                np.concatenate([y.cpu().numpy() for y in self.y_trues], axis=0),
-                np.concatenate([y.cpu().numpy() for y in self.y_preds], axis=0)
-            )
-            return torch.tensor(score, device=self.y_trues[0].device)
-        except ValueError:
-            return torch.tensor(0.0, device=self.y_trues[0].device)
+        denom = 2 * self.tp + self.fp + self.fn
+        if self.invalid > 0 or denom == 0:
+            return torch.tensor(0.0, device=self.tp.device)
+        return 2 * self.tp / denom
@@ -7,7 +7,7 @@ from transformers.models.bert.modeling_bert import BertConfig, BertModel
 from m3ae.modules import objectives, m3ae_utils
 from m3ae.modules import prediction_heads
 from m3ae.modules.language_encoders.bert_model import BertCrossLayer
-from m3ae.modules.m3ae_utils import init_weights
+from m3ae.modules.m3ae_utils import apply_init_weights
 from m3ae.modules.vision_encoders import swin_transformer as swin
 from m3ae.modules.vision_encoders.clip_model import build_model, adapt_position_encoding
 from m3ae.modules.vision_encoders.swin_helpers import swin_adapt_position_encoding
@@ -68,36 +68,36 @@ class M3AETransformerSS(pl.LightningModule):
             self.language_encoder = BertModel.from_pretrained(config['tokenizer'])
 
         self.multi_modal_language_proj = nn.Linear(config['input_text_embed_size'], config['hidden_size'])
-        self.multi_modal_language_proj.apply(init_weights)
+        apply_init_weights(self.multi_modal_language_proj)
         self.multi_modal_vision_proj = nn.Linear(config['input_image_embed_size'], config['hidden_size'])
-        self.multi_modal_vision_proj.apply(init_weights)
+        apply_init_weights(self.multi_modal_vision_proj)
 
         self.modality_type_embeddings = nn.Embedding(2, config["hidden_size"])
-        self.modality_type_embeddings.apply(init_weights)
+        apply_init_weights(self.modality_type_embeddings)
 
         self.multi_modal_vision_layers = nn.ModuleList(
             [BertCrossLayer(bert_config) for _ in range(config['num_top_layer'])])
-        self.multi_modal_vision_layers.apply(init_weights)
+        apply_init_weights(self.multi_modal_vision_layers)
         self.multi_modal_language_layers = nn.ModuleList(
             [BertCrossLayer(bert_config) for _ in range(config['num_top_layer'])])
-        self.multi_modal_language_layers.apply(init_weights)
+        apply_init_weights(self.multi_modal_language_layers)
 
         self.multi_modal_vision_pooler = prediction_heads.Pooler(config["hidden_size"])
-        self.multi_modal_vision_pooler.apply(init_weights)
+        apply_init_weights(self.multi_modal_vision_pooler)
         self.multi_modal_language_pooler = prediction_heads.Pooler(config["hidden_size"])
-        self.multi_modal_language_pooler.apply(init_weights)
+        apply_init_weights(self.multi_modal_language_pooler)
         # == End  : 1. Build Models ==
 
         # == Begin: 2. Build Pre-Training Heads ==
         if config["loss_names"]["mlm"] > 0:
             self.mlm_head = prediction_heads.MLMHead(bert_config)
-            self.mlm_head.apply(init_weights)
+            apply_init_weights(self.mlm_head)
         if config["loss_names"]["mim"] > 0:
             self.mim_head = prediction_heads.MIMHead(config)
-            self.mim_head.apply(init_weights)
+            apply_init_weights(self.mim_head)
         if config["loss_names"]["itm"] > 0 or self.hparams.config["loss_names"]["irtr"] > 0:
             self.itm_head = prediction_heads.ITMHead(config["hidden_size"] * 2)
-            self.itm_head.apply(init_weights)
+            apply_init_weights(self.itm_head)
         # == End  : 2. Build Pre-Training Heads ==
 
         # == Begin: 3. Load Models ==
@@ -123,7 +123,7 @@ class M3AETransformerSS(pl.LightningModule):
                 nn.GELU(),
                 nn.Linear(hs * 2, vs),
             )
-            self.vqa_head.apply(init_weights)
+            apply_init_weights(self.vqa_head)
 
         m3ae_utils.set_metrics(self)
         self.current_tasks = list()
@@ -1,37 +1,37 @@
+import re
+
 import torch
 import torch.nn as nn
 from transformers import get_polynomial_decay_schedule_with_warmup, get_cosine_schedule_with_warmup
 from transformers.optimization import AdamW
 
 from .objectives import compute_irtr_recall 
-from ..gadgets.my_metrics import VQARADScore, Accuracy, Scalar, ROUGE1Score, ROUGE2Score, BLEUScore, VQAExactMatch
+from .m3ae_utils import add_metric
+from ..gadgets.my_metrics import VQARADScore, Accuracy, Scalar, TextMetricsBundle, VQAExactMatch
 
 def set_metrics(pl_module):
+    pl_module._metric_registry = {}
+    log_text_metrics_train = pl_module.hparams.m3ae_config.get("log_text_metrics_train", False)
     for split in ["train", "val", "test"]:
         for k, v in pl_module.hparams.m3ae_config["loss_names"].items():
             if v <= 0:
                 continue
             if split == "train":
-                setattr(pl_module, f"train_{k}_score", VQARADScore())
-                setattr(pl_module, f"train_{k}_rouge1", ROUGE1Score())
-                setattr(pl_module, f"train_{k}_rouge2", ROUGE2Score())
-                setattr(pl_module, f"train_{k}_bleu_score", BLEUScore())
-                setattr(pl_module, f"train_{k}_loss", Scalar())
-                setattr(pl_module, f"train_{k}_exact_match", VQAExactMatch())
+                add_metric(pl_module, "train", k, "score", VQARADScore())
+                if log_text_metrics_train:
+                    add_metric(pl_module, "train", k, "text", TextMetricsBundle())
+                add_metric(pl_module, "train", k, "loss", Scalar())
+                add_metric(pl_module, "train", k, "exact_match", VQAExactMatch())
             else:
-                setattr(pl_module, f"val_{k}_score", VQARADScore())
-                setattr(pl_module, f"val_{k}_rouge1", ROUGE1Score())
-                setattr(pl_module, f"val_{k}_rouge2", ROUGE2Score())
-                setattr(pl_module, f"val_{k}_bleu_score", BLEUScore())
-                setattr(pl_module, f"val_{k}_loss", Scalar())
-                setattr(pl_module, f"val_{k}_exact_match", VQAExactMatch())
-
-                setattr(pl_module, f"test_{k}_score", VQARADScore())
-                setattr(pl_module, f"test_{k}_rouge1",ROUGE1Score())
-                setattr(pl_module, f"test_{k}_rouge2",ROUGE2Score())
-                setattr(pl_module, f"test_{k}_bleu_score", BLEUScore())
-                setattr(pl_module, f"test_{k}_loss", Scalar())
-                setattr(pl_module, f"test_{k}_exact_match", VQAExactMatch())
+                add_metric(pl_module, "val", k, "score", VQARADScore())
+                add_metric(pl_module, "val", k, "text", TextMetricsBundle())
+                add_metric(pl_module, "val", k, "loss", Scalar())
+                add_metric(pl_module, "val", k, "exact_match", VQAExactMatch())
+
+                add_metric(pl_module, "test", k, "score", VQARADScore())
+                add_metric(pl_module, "test", k, "text", TextMetricsBundle())
+                add_metric(pl_module, "test", k, "loss", Scalar())
+                add_metric(pl_module, "test", k, "exact_match", VQAExactMatch())
 
 def epoch_wrapup(pl_module, test=False):
     if test:
@@ -40,70 +40,73 @@ def epoch_wrapup(pl_module, test=False):
         phase = "train" if pl_module.training else "val"
 
     the_metric = 0
+    metrics = pl_module._metric_registry
 
     for loss_name, v in pl_module.hparams.m3ae_config["loss_names"].items():
         if v <= 0:
             continue
         value = 0
         if loss_name == "vqa":
-            # print(pl_module)
-            value = getattr(pl_module, f"{phase}_{loss_name}_score").compute()
+            value = metrics[(phase, loss_name, "score")].compute()
             pl_module.log(f"{loss_name}/{phase}/score_epoch", value)
             pl_module.log(f"{loss_name}/{phase}/score_best_epoch",
-                          getattr(pl_module, f"{phase}_{loss_name}_score").get_best_score())
+                          metrics[(phase, loss_name, "score")].get_best_score())
             pl_module.log(f"{loss_name}/{phase}/close_score_best_epoch",
-                          getattr(pl_module, f"{phase}_{loss_name}_score").get_best_close_score())
+                          metrics[(phase, loss_name, "score")].get_best_close_score())
             pl_module.log(f"{loss_name}/{phase}/open_score_best_epoch",
-                          getattr(pl_module, f"{phase}_{loss_name}_score").get_best_open_score())
-            getattr(pl_module, f"{phase}_{loss_name}_score").reset()
+                          metrics[(phase, loss_name, "score")].get_best_open_score())
+            metrics[(phase, loss_name, "score")].reset()
 
-            pl_module.log(f"{loss_name}/{phase}/loss_epoch", getattr(pl_module, f"{phase}_{loss_name}_loss").compute())
-            getattr(pl_module, f"{phase}_{loss_name}_loss").reset()
+            pl_module.log(f"{loss_name}/{phase}/loss_epoch", metrics[(phase, loss_name, "loss")].compute())
+            metrics[(phase, loss_name, "loss")].reset()
 
             # Log additional metrics: ROUGE1, ROUGE2, BLEU 
-            metrics = ["rouge1", "rouge2", "bleu_score", "exact_match"]
-            for metric in metrics:
-                # print(f"\nlogging epoch metric: {phase} {metric}")
-                metric_value = getattr(pl_module, f"{phase}_{loss_name}_{metric}").compute()
-                #pl_module.log(f"{loss_name}/{phase}/{metric}", metric_value)
-                pl_module.log(f"{phase}/{metric}_epoch", metric_value)
-                getattr(pl_module, f"{phase}_{loss_name}_{metric}").reset()            
+            if (phase, loss_name, "text") in metrics:
+                text_scores = metrics[(phase, loss_name, "text")].compute()
+                pl_module.log(f"{phase}/rouge1_epoch", text_scores["rouge1"])
+                pl_module.log(f"{phase}/rouge2_epoch", text_scores["rouge2"])
+                pl_module.log(f"{phase}/bleu_score_epoch", text_scores["bleu"])
+                metrics[(phase, loss_name, "text")].reset()
+
+            exact_match = metrics[(phase, loss_name, "exact_match")].compute()
+            pl_module.log(f"{phase}/exact_match_epoch", exact_match)
+            metrics[(phase, loss_name, "exact_match")].reset()
 
         elif loss_name == "cls":
-            value = getattr(pl_module, f"{phase}_{loss_name}_accuracy").compute()
+            value = metrics[(phase, loss_name, "accuracy")].compute()
             pl_module.log(f"{loss_name}/{phase}/accuracy_epoch", value)
-            getattr(pl_module, f"{phase}_{loss_name}_accuracy").reset()
-            pl_module.log(f"{loss_name}/{phase}/loss_epoch", getattr(pl_module, f"{phase}_{loss_name}_loss").compute())
-            getattr(pl_module, f"{phase}_{loss_name}_loss").reset()
+            metrics[(phase, loss_name, "accuracy")].reset()
+            pl_module.log(f"{loss_name}/{phase}/loss_epoch", metrics[(phase, loss_name, "loss")].compute())
+            metrics[(phase, loss_name, "loss")].reset()
 
         elif loss_name == "irtr":
-            value = getattr(pl_module, f"{phase}_irtr_loss").compute()
+            value = metrics[(phase, loss_name, "loss")].compute()
             pl_module.log(f"{loss_name}/{phase}/irtr_loss_epoch", value)
-            getattr(pl_module, f"{phase}_irtr_loss").reset()
+            metrics[(phase, loss_name, "loss")].reset()
             value = -value
 
         elif loss_name == "itm":
-            value = getattr(pl_module, f"{phase}_{loss_name}_accuracy").compute()
+            value = metrics[(phase, loss_name, "accuracy")].compute()
             pl_module.log(f"{loss_name}/{phase}/accuracy_epoch", value)
-            getattr(pl_module, f"{phase}_{loss_name}_accuracy").reset()
-            pl_module.log(f"{loss_name}/{phase}/loss_epoch", getattr(pl_module, f"{phase}_{loss_name}_loss").compute())
-            getattr(pl_module, f"{phase}_{loss_name}_loss").reset()
+            metrics[(phase, loss_name, "accuracy")].reset()
+            pl_module.log(f"{loss_name}/{phase}/loss_epoch", metrics[(phase, loss_name, "loss")].compute())
+            metrics[(phase, loss_name, "loss")].reset()
 
         elif loss_name == "mim":
-            value = -getattr(pl_module, f"{phase}_{loss_name}_loss").compute()
+            value = -metrics[(phase, loss_name, "loss")].compute()
             pl_module.log(f"{loss_name}/{phase}/accuracy_epoch", value)
             pl_module.log(f"{loss_name}/{phase}/loss_epoch", - value)
-            getattr(pl_module, f"{phase}_{loss_name}_loss").reset()
+            metrics[(phase, loss_name, "loss")].reset()
 
         elif loss_name == "mlm":
-            value = getattr(pl_module, f"{phase}_{loss_name}_accuracy").compute()
+            value = metrics[(phase, loss_name, "accuracy")].compute()
             pl_module.log(f"{loss_name}/{phase}/accuracy_epoch", value)
-            getattr(pl_module, f"{phase}_{loss_name}_accuracy").reset()
+            metrics[(phase, loss_name, "accuracy")].reset()
             pl_module.log(
                 f"{loss_name}/{phase}/loss_epoch",
-                getattr(pl_module, f"{phase}_{loss_name}_loss").compute(),
+                metrics[(phase, loss_name, "loss")].compute(),
             )
-            getattr(pl_module, f"{phase}_{loss_name}_loss").reset()
+            metrics[(phase, loss_name, "loss")].reset()
         else:
             raise ValueError
 
@@ -311,25 +314,16 @@ def set_schedule_decoder(pl_module):
         "norm.weight",
     ]
 
+    no_decay_re = re.compile("|".join(map(re.escape, no_decay)))
+    decay_params, no_decay_params = [], []
+    for n, p in pl_module.named_parameters():
+        (no_decay_params if no_decay_re.search(n) else decay_params).append(p)
+
     optimizer_grouped_parameters = [
         # Parameters with weight decay
-        {
-            "params": [
-                p for n, p in pl_module.named_parameters()
-                if not any(nd in n for nd in no_decay)
-            ],
-            "weight_decay": wd,
-            "lr": lr,
-        },
+        {"params": decay_params, "weight_decay": wd, "lr": lr},
         # Parameters without weight decay
-        {
-            "params": [
-                p for n, p in pl_module.named_parameters()
-                if any(nd in n for nd in no_decay)
-            ],
-            "weight_decay": 0.0,
-            "lr": lr,
-        },
+        {"params": no_decay_params, "weight_decay": 0.0, "lr": lr},
     ]
 
     # Optimizer selection
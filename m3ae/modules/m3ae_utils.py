@@ -1,13 +1,24 @@
+import re
+
 import torch
 import torch.nn as nn
 from transformers import get_polynomial_decay_schedule_with_warmup, get_cosine_schedule_with_warmup
 from transformers.optimization import AdamW
 
 from .objectives import compute_irtr_recall
-from ..gadgets.my_metrics import Accuracy, Scalar, VQARADScore, ROUGE1Score, ROUGE2Score, BLEUScore, VQAExactMatch
+from ..gadgets.my_metrics import Accuracy, Scalar, VQARADScore, TextMetricsBundle, VQAExactMatch
+
+
+def add_metric(pl_module, phase, loss_name, metric_name, metric):
+    # keep setattr so Lightning tracks the metric, plus a direct reference for the hot paths
+    setattr(pl_module, f"{phase}_{loss_name}_{metric_name}", metric)
+    pl_module._metric_registry[(phase, loss_name, metric_name)] = metric
 
 
 def set_metrics(pl_module):
+    pl_module._metric_registry = {}
+    # ROUGE/BLEU on every training batch is expensive, so it is opt-in
+    log_text_metrics_train = pl_module.hparams.config.get("log_text_metrics_train", False)
     for split in ["train", "val", "test"]:
         for k, v in pl_module.hparams.config["loss_names"].items():
             if v <= 0:
@@ -15,37 +26,32 @@ def set_metrics(pl_module):
 
             if k == "vqa":
                 if split == "train":
-                    setattr(pl_module, f"train_{k}_score", VQARADScore())
-                    setattr(pl_module, f"train_{k}_rouge1", ROUGE1Score())
-                    setattr(pl_module, f"train_{k}_rouge2", ROUGE2Score())
-                    setattr(pl_module, f"train_{k}_bleu_score", BLEUScore())
-                    setattr(pl_module, f"train_{k}_loss", Scalar())
-                    setattr(pl_module, f"train_{k}_exact_match", VQAExactMatch())
+                    add_metric(pl_module, "train", k, "score", VQARADScore())
+                    if log_text_metrics_train:
+                        add_metric(pl_module, "train", k, "text", TextMetricsBundle())
+                    add_metric(pl_module, "train", k, "loss", Scalar())
+                    add_metric(pl_module, "train", k, "exact_match", VQAExactMatch())
                 else:
-                    setattr(pl_module, f"val_{k}_score", VQARADScore())
-                    setattr(pl_module, f"val_{k}_rouge1", ROUGE1Score())
-                    setattr(pl_module, f"val_{k}_rouge2", ROUGE2Score())
-                    setattr(pl_module, f"val_{k}_bleu_score", BLEUScore())
-                    setattr(pl_module, f"val_{k}_loss", Scalar())
-                    setattr(pl_module, f"val_{k}_exact_match", VQAExactMatch())
+                    add_metric(pl_module, "val", k, "score", VQARADScore())
+                    add_metric(pl_module, "val", k, "text", TextMetricsBundle())
+                    add_metric(pl_module, "val", k, "loss", Scalar())
+                    add_metric(pl_module, "val", k, "exact_match", VQAExactMatch())
 
-                    setattr(pl_module, f"test_{k}_score", VQARADScore())
-                    setattr(pl_module, f"test_{k}_rouge1",ROUGE1Score())
-                    setattr(pl_module, f"test_{k}_rouge2",ROUGE2Score())
-                    setattr(pl_module, f"test_{k}_bleu_score", BLEUScore())
-                    setattr(pl_module, f"test_{k}_loss", Scalar())
-                    setattr(pl_module, f"test_{k}_exact_match", VQAExactMatch())
+                    add_metric(pl_module, "test", k, "score", VQARADScore())
+                    add_metric(pl_module, "test", k, "text", TextMetricsBundle())
+                    add_metric(pl_module, "test", k, "loss", Scalar())
+                    add_metric(pl_module, "test", k, "exact_match", VQAExactMatch())
 
 
             elif k == "cls":
                 if split == "train":
-                    setattr(pl_module, f"train_{k}_accuracy", Accuracy())
-                    setattr(pl_module, f"train_{k}_loss", Scalar())
+                    add_metric(pl_module, "train", k, "accuracy", Accuracy())
+                    add_metric(pl_module, "train", k, "loss", Scalar())
                 else:
-                    setattr(pl_module, f"val_{k}_accuracy", Accuracy())
-                    setattr(pl_module, f"val_{k}_loss", Scalar())
-                    setattr(pl_module, f"test_{k}_accuracy", Accuracy())
-                    setattr(pl_module, f"test_{k}_loss", Scalar())
+                    add_metric(pl_module, "val", k, "accuracy", Accuracy())
+                    add_metric(pl_module, "val", k, "loss", Scalar())
+                    add_metric(pl_module, "test", k, "accuracy", Accuracy())
+                    add_metric(pl_module, "test", k, "loss", Scalar())
 
             else:
                 raise ValueError
@@ -62,27 +68,31 @@ def epoch_wrapup(pl_module, test=False):
             continue
         value = 0
         if loss_name == "vqa":
-            #print(pl_module)
-            value = getattr(pl_module, f"{phase}_{loss_name}_score").compute()
+            metrics = pl_module._metric_registry
+            value = metrics[(phase, loss_name, "score")].compute()
             pl_module.log(f"{loss_name}/{phase}/score_epoch", value)
             pl_module.log(f"{loss_name}/{phase}/score_best_epoch",
-                          getattr(pl_module, f"{phase}_{loss_name}_score").get_best_score())
+                          metrics[(phase, loss_name, "score")].get_best_score())
             pl_module.log(f"{loss_name}/{phase}/close_score_best_epoch",
-                          getattr(pl_module, f"{phase}_{loss_name}_score").get_best_close_score())
+                          metrics[(phase, loss_name, "score")].get_best_close_score())
             pl_module.log(f"{loss_name}/{phase}/open_score_best_epoch",
-                          getattr(pl_module, f"{phase}_{loss_name}_score").get_best_open_score())
-            getattr(pl_module, f"{phase}_{loss_name}_score").reset()
+                          metrics[(phase, loss_name, "score")].get_best_open_score())
+            metrics[(phase, loss_name, "score")].reset()
 
-            pl_module.log(f"{loss_name}/{phase}/loss_epoch", getattr(pl_module, f"{phase}_{loss_name}_loss").compute())
-            getattr(pl_module, f"{phase}_{loss_name}_loss").reset()
+            pl_module.log(f"{loss_name}/{phase}/loss_epoch", metrics[(phase, loss_name, "loss")].compute())
+            metrics[(phase, loss_name, "loss")].reset()
 
             # Log additional metrics: ROUGE1, ROUGE2, BLEU 
-            metrics = ["rouge1", "rouge2", "bleu_score", "exact_match"]
-            for metric in metrics:
-                metric_value = getattr(pl_module, f"{phase}_{loss_name}_{metric}").compute()
-                #pl_module.log(f"{loss_name}/{phase}/{metric}", metric_value)
-                pl_module.log(f"{phase}/{metric}_epoch", metric_value)
-                getattr(pl_module, f"{phase}_{loss_name}_{metric}").reset()    
+            if (phase, loss_name, "text") in metrics:
+                text_scores = metrics[(phase, loss_name, "text")].compute()
+                pl_module.log(f"{phase}/rouge1_epoch", text_scores["rouge1"])
+                pl_module.log(f"{phase}/rouge2_epoch", text_scores["rouge2"])
+                pl_module.log(f"{phase}/bleu_score_epoch", text_scores["bleu"])
+                metrics[(phase, loss_name, "text")].reset()
+
+            exact_match = metrics[(phase, loss_name, "exact_match")].compute()
+            pl_module.log(f"{phase}/exact_match_epoch", exact_match)
+            metrics[(phase, loss_name, "exact_match")].reset()
 
 
 def check_non_acc_grad(pl_module):
@@ -109,6 +119,31 @@ def init_weights(module):
         module.bias.data.zero_()
 
 
+def apply_init_weights(module):
+    # same result as module.apply(init_weights), but collects the tensors in one walk and
+    # fills them with foreach calls: one for the zeros group, and zero_ then add_(1.0) for the
+    # ones group, since torch 1.9 has no foreach fill
+    normal_weights, zero_tensors, one_tensors = [], [], []
+    for m in module.modules():
+        if isinstance(m, (nn.Linear, nn.Embedding)):
+            normal_weights.append(m.weight.data)
+        elif isinstance(m, nn.LayerNorm):
+            zero_tensors.append(m.bias.data)
+            one_tensors.append(m.weight.data)
+
+        if isinstance(m, nn.Linear) and m.bias is not None:
+            zero_tensors.append(m.bias.data)
+
+    # normal_ has no foreach variant; module order is kept so the RNG stream matches apply()
+    for weight in normal_weights:
+        weight.normal_(mean=0.0, std=0.02)
+    if zero_tensors:
+        torch._foreach_zero_(zero_tensors)
+    if one_tensors:
+        torch._foreach_zero_(one_tensors)
+        torch._foreach_add_(one_tensors, 1.0)
+
+
 def set_schedule(pl_module):
     lr = pl_module.hparams.config["learning_rate"]
     wd = pl_module.hparams.config["weight_decay"]
@@ -132,72 +167,37 @@ def set_schedule(pl_module):
     head_names = ["mlm_head", "mim_head", "itm_head", "vqa_head", "cls_head", "irtr_head"]
     multi_modal_names = ['multi_modal']
 
+    # one alternation per category keeps the substring semantics of any(x in n for x in names)
+    # (e.g. swin's relative_position_bias_table is no-decay) while scanning each name once
+    no_decay_re = re.compile("|".join(map(re.escape, no_decay)))
+    head_re = re.compile("|".join(map(re.escape, head_names)))
+    multi_modal_re = re.compile("|".join(map(re.escape, multi_modal_names)))
+
+    # classify every parameter in a single pass; parameters that are both head and
+    # multi-modal match none of the groups, as before
+    base_decay, base_no_decay = [], []
+    head_decay, head_no_decay = [], []
+    multi_modal_decay, multi_modal_no_decay = [], []
+    for n, p in pl_module.named_parameters():
+        is_no_decay = no_decay_re.search(n) is not None
+        is_head = head_re.search(n) is not None
+        is_multi_modal = multi_modal_re.search(n) is not None
+        if is_head and is_multi_modal:
+            continue
+        if is_head:
+            (head_no_decay if is_no_decay else head_decay).append(p)
+        elif is_multi_modal:
+            (multi_modal_no_decay if is_no_decay else multi_modal_decay).append(p)
+        else:
+            (base_no_decay if is_no_decay else base_decay).append(p)
+
     optimizer_grouped_parameters = [
-        {
-            "params": [
-                p
-                for n, p in pl_module.named_parameters()
-                if not any(nd in n for nd in no_decay)
-                   and not any(bb in n for bb in head_names)
-                   and not any(ht in n for ht in multi_modal_names)
-            ],
-            "weight_decay": wd,
-            "lr": lr,
-        },
-        {
-            "params": [
-                p
-                for n, p in pl_module.named_parameters()
-                if any(nd in n for nd in no_decay)
-                   and not any(bb in n for bb in head_names)
-                   and not any(ht in n for ht in multi_modal_names)
-            ],
-            "weight_decay": 0.0,
-            "lr": lr,
-        },
-        {
-            "params": [
-                p
-                for n, p in pl_module.named_parameters()
-                if not any(nd in n for nd in no_decay)
-                   and any(bb in n for bb in head_names)
-                   and not any(ht in n for ht in multi_modal_names)
-            ],
-            "weight_decay": wd,
-            "lr": lr * lr_multiplier_head,
-        },
-        {
-            "params": [
-                p
-                for n, p in pl_module.named_parameters()
-                if any(nd in n for nd in no_decay) and any(bb in n for bb in head_names)
-                   and not any(ht in n for ht in multi_modal_names)
-            ],
-            "weight_decay": 0.0,
-            "lr": lr * lr_multiplier_head,
-        },
-        {
-            "params": [
-                p
-                for n, p in pl_module.named_parameters()
-                if not any(nd in n for nd in no_decay)
-                   and not any(bb in n for bb in head_names)
-                   and any(ht in n for ht in multi_modal_names)
-            ],
-            "weight_decay": wd,
-            "lr": lr * lr_multiplier_multi_modal,
-        },
-        {
-            "params": [
-                p
-                for n, p in pl_module.named_parameters()
-                if any(nd in n for nd in no_decay)
-                   and not any(bb in n for bb in head_names)
-                   and any(ht in n for ht in multi_modal_names)
-            ],
-            "weight_decay": 0.0,
-            "lr": lr * lr_multiplier_multi_modal,
-        },
+        {"params": base_decay, "weight_decay": wd, "lr": lr},
+        {"params": base_no_decay, "weight_decay": 0.0, "lr": lr},
+        {"params": head_decay, "weight_decay": wd, "lr": lr * lr_multiplier_head},
+        {"params": head_no_decay, "weight_decay": 0.0, "lr": lr * lr_multiplier_head},
+        {"params": multi_modal_decay, "weight_decay": wd, "lr": lr * lr_multiplier_multi_modal},
+        {"params": multi_modal_no_decay, "weight_decay": 0.0, "lr": lr * lr_multiplier_multi_modal},
     ]
 
     if optim_type == "adamw":
@@ -30,8 +30,8 @@ def compute_mlm(pl_module, batch):
     }
 
     phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_mlm_loss")(ret["mlm_loss"])
-    acc = getattr(pl_module, f"{phase}_mlm_accuracy")(ret["mlm_logits"], ret["mlm_labels"])
+    loss = pl_module._metric_registry[(phase, "mlm", "loss")](ret["mlm_loss"])
+    acc = pl_module._metric_registry[(phase, "mlm", "accuracy")](ret["mlm_logits"], ret["mlm_labels"])
     pl_module.log(f"mlm/{phase}/loss", loss)
     pl_module.log(f"mlm/{phase}/accuracy", acc)
 
@@ -68,7 +68,7 @@ def compute_mim(pl_module, batch):
     }
 
     phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_mim_loss")(ret["mim_loss"])
+    loss = pl_module._metric_registry[(phase, "mim", "loss")](ret["mim_loss"])
     acc = -loss
     pl_module.log(f"mim/{phase}/loss", loss)
     pl_module.log(f"mim/{phase}/accuracy", acc)
@@ -111,8 +111,8 @@ def compute_itm(pl_module, batch):
     else:
         phase = "train" if pl_module.training else "val"
 
-    loss = getattr(pl_module, f"{phase}_itm_loss")(ret["itm_loss"])
-    acc = getattr(pl_module, f"{phase}_itm_accuracy")(ret["itm_logits"], ret["itm_labels"])
+    loss = pl_module._metric_registry[(phase, "itm", "loss")](ret["itm_loss"])
+    acc = pl_module._metric_registry[(phase, "itm", "accuracy")](ret["itm_logits"], ret["itm_labels"])
     pl_module.log(f"itm/{phase}/loss", loss)
     pl_module.log(f"itm/{phase}/accuracy", acc)
 
@@ -150,25 +150,27 @@ def compute_vqa(pl_module, batch, test, outputs, loss, labels):
         phase = "test"
     else:
         phase = "train" if pl_module.training else "val"
+    metrics = pl_module._metric_registry
 
-    loss = getattr(pl_module, f"{phase}_vqa_loss")(ret["vqa_loss"])
-    rouge1 = getattr(pl_module, f"{phase}_vqa_rouge1")(ret["vqa_logits"], ret["vqa_labels"])
-    rouge2 = getattr(pl_module, f"{phase}_vqa_rouge2")(ret["vqa_logits"], ret["vqa_labels"])
-    bleu = getattr(pl_module, f"{phase}_vqa_bleu_score")(ret["vqa_logits"], ret["vqa_labels"])
-    exact_match = getattr(pl_module, f"{phase}_vqa_exact_match")(ret["vqa_logits"], ret["vqa_labels"])
+    loss = metrics[(phase, "vqa", "loss")](ret["vqa_loss"])
+    exact_match = metrics[(phase, "vqa", "exact_match")](ret["vqa_logits"], ret["vqa_labels"])
+
+    # ROUGE/BLEU are only registered for training when log_text_metrics_train is set
+    if (phase, "vqa", "text") in metrics:
+        text_scores = metrics[(phase, "vqa", "text")](ret["vqa_logits"], ret["vqa_labels"])
+        pl_module.log(f"{phase}/vqa/rouge1", text_scores["rouge1"])
+        pl_module.log(f"{phase}/vqa/rouge2", text_scores["rouge2"])
+        pl_module.log(f"{phase}/vqa/bleu", text_scores["bleu"])
 
     if phase == 'test':
         print(f'model output: {ret["vqa_logits"]},\n labels: {ret["vqa_labels"]}')
 
-    # score = getattr(pl_module, f"{phase}_vqa_score")(ret["vqa_logits"], ret["vqa_targets"], ret["vqa_answer_types"])
+    # score = metrics[(phase, "vqa", "score")](ret["vqa_logits"], ret["vqa_targets"], ret["vqa_answer_types"])
     # pl_module.log(f"{phase}/vqa/score", score)
 
     # print(f"logging for phase: {phase}")
 
     pl_module.log(f"{phase}/vqa/loss", loss)
-    pl_module.log(f"{phase}/vqa/rouge1", rouge1)
-    pl_module.log(f"{phase}/vqa/rouge2", rouge2)
-    pl_module.log(f"{phase}/vqa/bleu", bleu)
     pl_module.log(f"{phase}/vqa/exact_match", exact_match)
 
     return ret
@@ -215,20 +217,22 @@ def compute_vqa_m3ae(pl_module, batch, test):
         phase = "test"
     else:
         phase = "train" if pl_module.training else "val"
+    metrics = pl_module._metric_registry
+
+    loss = metrics[(phase, "vqa", "loss")](ret["vqa_loss"])
+    exact_match = metrics[(phase, "vqa", "exact_match")](ret["vqa_model_answers"], ret["vqa_true_answers"])
 
-    loss = getattr(pl_module, f"{phase}_vqa_loss")(ret["vqa_loss"])
-    rouge1 = getattr(pl_module, f"{phase}_vqa_rouge1")(ret["vqa_model_answers"], ret["vqa_true_answers"])
-    rouge2 = getattr(pl_module, f"{phase}_vqa_rouge2")(ret["vqa_model_answers"], ret["vqa_true_answers"])
-    bleu = getattr(pl_module, f"{phase}_vqa_bleu_score")(ret["vqa_model_answers"], ret["vqa_true_answers"])
-    exact_match = getattr(pl_module, f"{phase}_vqa_exact_match")(ret["vqa_model_answers"], ret["vqa_true_answers"])
+    # ROUGE/BLEU are only registered for training when log_text_metrics_train is set
+    if (phase, "vqa", "text") in metrics:
+        text_scores = metrics[(phase, "vqa", "text")](ret["vqa_model_answers"], ret["vqa_true_answers"])
+        pl_module.log(f"{phase}/vqa/rouge1", text_scores["rouge1"])
+        pl_module.log(f"{phase}/vqa/rouge2", text_scores["rouge2"])
+        pl_module.log(f"{phase}/vqa/bleu", text_scores["bleu"])
 
-    score = getattr(pl_module, f"{phase}_vqa_score")(ret["vqa_logits"], ret["vqa_targets"], ret["vqa_answer_types"])
+    score = metrics[(phase, "vqa", "score")](ret["vqa_logits"], ret["vqa_targets"], ret["vqa_answer_types"])
     pl_module.log(f"{phase}/vqa/score", score)
 
     pl_module.log(f"{phase}/vqa/loss", loss)
-    pl_module.log(f"{phase}/vqa/rouge1", rouge1)
-    pl_module.log(f"{phase}/vqa/rouge2", rouge2)
-    pl_module.log(f"{phase}/vqa/bleu", bleu)
     pl_module.log(f"{phase}/vqa/exact_match", exact_match)
 
     return ret
@@ -252,8 +256,8 @@ def compute_cls(pl_module, batch, test=False):
     else:
         phase = "train" if pl_module.training else "val"
 
-    loss = getattr(pl_module, f"{phase}_cls_loss")(ret["cls_loss"])
-    acc = getattr(pl_module, f"{phase}_cls_accuracy")(ret["cls_logits"], ret["cls_labels"])
+    loss = pl_module._metric_registry[(phase, "cls", "loss")](ret["cls_loss"])
+    acc = pl_module._metric_registry[(phase, "cls", "accuracy")](ret["cls_logits"], ret["cls_labels"])
     pl_module.log(f"cls/{phase}/loss", loss)
     pl_module.log(f"cls/{phase}/accuracy", acc)
 
@@ -294,7 +298,7 @@ def compute_irtr(pl_module, batch, test=False):
     else:
         phase = "train" if pl_module.training else "val"
 
-    irtr_loss = getattr(pl_module, f"{phase}_irtr_loss")(ret["irtr_loss"])
+    irtr_loss = pl_module._metric_registry[(phase, "irtr", "loss")](ret["irtr_loss"])
     pl_module.log(f"irtr/{phase}/irtr_loss", irtr_loss)
 
     return ret